@@ -78,13 +78,21 @@ class StorerCourseConfig(CourseConfig):
 
     def assignments(self):
         """Return an AssignmentsConfig object describing the
-        assignments in this course's config file"""
-        return AssignmentsConfig(self)
+        assignments in this course's config file.
+
+        The object is built on the first call and shared afterwards."""
+        if not hasattr(self, '_assignments'):
+            self._assignments = AssignmentsConfig(self)
+        return self._assignments
 
     def testers(self):
         """Return an TestersConfig object describing the
-        tester machines used."""
-        return TestersConfig(self)
+        tester machines used.
+
+        The object is built on the first call and shared afterwards."""
+        if not hasattr(self, '_testers'):
+            self._testers = TestersConfig(self)
+        return self._testers
 
 class TesterCourseConfig(CourseConfig):
     def root_path_queue_manager(self):
@@ -301,6 +309,45 @@ class AssignmentsConfig(ConfigWithDefaults, AssignmentConfig):
 
     def __init__(self, config):
         ConfigWithDefaults.__init__(self, config, 'assignment ')
+        self._settings = {}
+
+    def settings(self, assignment):
+        """Return a dict with the already parsed values of the options
+        checked for every submission of `assignment':
+
+            machine       - see get_machine_id()
+            storage       - 'AssignmentStorage' in lowercase, '' if unset
+            deadline      - the 'Deadline' string, None if unset
+            deadline_ts   - the deadline in seconds since the epoch,
+                            None if unset
+            hard_deadline - see is_deadline_hard()
+            timedelta     - see timedelta(), None if unset
+            max_size      - see max_submission_size()
+            submit_only   - see submit_only()
+            hidden        - see is_hidden()
+
+        The dict is built on the first call for each assignment.
+        """
+        if assignment not in self._settings:
+            deadline = self.getd(assignment, 'Deadline', None)
+            deadline_ts = None
+            if deadline is not None:
+                deadline_ts = time.mktime(time.strptime(deadline, DATE_FORMAT))
+            min_delay = None
+            if self.has(assignment, 'timedelta'):
+                min_delay = self.timedelta(assignment)
+            self._settings[assignment] = {
+                'machine'       : self.get_machine_id(assignment),
+                'storage'       : self.getd(assignment, 'AssignmentStorage', '').lower(),
+                'deadline'      : deadline,
+                'deadline_ts'   : deadline_ts,
+                'hard_deadline' : self.is_deadline_hard(assignment),
+                'timedelta'     : min_delay,
+                'max_size'      : self.max_submission_size(assignment),
+                'submit_only'   : self.submit_only(assignment),
+                'hidden'        : self.is_hidden(assignment),
+                }
+        return self._settings[assignment]
 
 
 class TesterConfig(Config):
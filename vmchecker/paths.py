@@ -151,6 +151,14 @@ def submission_archive_file(cur_submission_root):
     return os.path.join(cur_submission_root, 'archive.zip')
 
 
+def submission_archive_validated_file(cur_submission_root):
+    """Returns the path to the file recording that the users's
+    submission archive was checked not to override any bundle file.
+    """
+    # not stored in git
+    return os.path.join(cur_submission_root, '.archive_validated')
+
+
 def submission_md5_file(cur_submission_root):
     """Returns the path to the users's md5 hash.
 
@@ -191,14 +191,27 @@ class Submissions:
         account and assignment"""
         return (self._get_submission_config(assignment, account) != None)
 
+    def get_results_dest(self, assignment, account):
+        """Returns the directory where the results of the account's
+        last submission for the assignment are stored."""
+        hrc = self._get_submission_config(assignment, account)
+        if hrc == None:
+            return None
+        return hrc.get('Storer', 'ResultsDest')
+
     def write_grade(self, assignment, account, grade):
         """Write the grade to the current submission for the given
         account and assignment"""
-        results_path = self._get_submission_config(assignment, account).get('Storer', 'ResultsDest')
-        if results_path is None:
-            return
-        if not os.path.exists(results_path):
-            os.makedirs(results_path)
-        with open(os.path.join(results_path, 'grade.vmr'), 'wt') as f:
-            f.write(grade)
+        write_grade_to(self.get_results_dest(assignment, account), grade)
+
+
+def write_grade_to(results_path, grade):
+    """Write the grade to the results directory results_path of a
+    submission"""
+    if results_path is None:
+        return
+    if not os.path.exists(results_path):
+        os.makedirs(results_path)
+    with open(os.path.join(results_path, 'grade.vmr'), 'wt') as f:
+        f.write(grade)
 
@@ -10,13 +10,18 @@ For a better submission scheme see the commit:
 
 from __future__ import with_statement
 
-import ConfigParser
 import os
+import sys
+import stat
+import errno
+import atexit
 import shutil
 import subprocess
 import time
 import socket
-import random
+import pipes
+import tarfile
+import threading
 import datetime
 import paramiko
 import tempfile
@@ -30,7 +35,6 @@ from . import vmlogging
 from . import callback
 from . import update_db
 
-from penalty import str_to_time
 from ziputil import check_archive_for_file_override
 from ziputil import check_archive_size
 
@@ -41,6 +45,42 @@ logger = vmlogging.create_module_logger('submit')
 _DEFAULT_SSH_PORT = 22
 DEADLINE_GRACE_TIME = 60 # 1 minute
 
+# course_id -> (config file mtime, StorerCourseConfig, VmcheckerPaths)
+_COURSE_CFG_CACHE = {}
+
+# (tester hostname, tester username) -> paramiko.SSHClient
+_SSH_POOL = {}
+_SSH_POOL_LOCK = threading.Lock()
+_SSH_CONNECT_TIMEOUT = 30 # seconds
+# Pooled connections may sit idle for hours; keep NATs and firewalls
+# from silently dropping them.
+_SSH_KEEPALIVE_INTERVAL = 60 # seconds
+
+_STREAM_BUF_SIZE = 1 << 20
+_COPY_BUF_SIZE = 4 << 20
+
+# Files of the bundle that only change when the course staff updates
+# them (tests, build and run scripts). They are kept in memory between
+# bundles: path -> ((mtime, ctime, size), os.stat() result, contents)
+# Files larger than _STATIC_BUNDLE_PART_MAX_BYTES are not kept, but
+# read from disk by ZipFile.write() each time.
+_STATIC_BUNDLE_PARTS = {}
+_STATIC_BUNDLE_PARTS_MAX_BYTES = 64 << 20
+_STATIC_BUNDLE_PART_MAX_BYTES = 8 << 20
+
+# Bundle entries which are different for each submission
+_LIVE_BUNDLE_FILES = ['submission-config', 'archive.zip']
+
+# Bundles built by queue_for_testing(..., defer=True) that wait for
+# flush_pending(): (vmcfg, bundle_path, tester, assignment, account,
+# course_id, results_dest, time deferred)
+_pending_bundles = []
+_PENDING_LOCK = threading.Lock()
+# queue_for_testing() flushes the deferred bundles once there are this
+# many of them, or once the oldest one waited this many seconds.
+_PENDING_MAX_BUNDLES = 16
+_PENDING_MAX_AGE = 30
+
 class SubmittedTooSoonError(Exception):
     """Raised when a user sends a submission too soon after a previous one.
 
@@ -66,6 +106,24 @@ class SubmittedHiddenAssignmentError(Exception):
         Exception.__init__(self, message)
 
 
+def _get_vmcfg(course_id):
+    """Returns a (vmcfg, vmpaths) tuple for the given course.
+
+    Parsing the course config is the most expensive part of setting
+    up a submission, so the result is kept for the lifetime of the
+    process and thrown away only when the config file changes.
+    """
+    config_file = CourseList().course_config(course_id)
+    mtime = os.path.getmtime(os.path.expanduser(config_file))
+    cached = _COURSE_CFG_CACHE.get(course_id)
+    if cached is None or cached[0] != mtime:
+        vmcfg = config.StorerCourseConfig(config_file)
+        vmpaths = paths.VmcheckerPaths(vmcfg.root_path())
+        cached = (mtime, vmcfg, vmpaths)
+        _COURSE_CFG_CACHE[course_id] = cached
+    return cached[1], cached[2]
+
+
 def submission_config(vmcfg, account, assignment, course_id, upload_time,
                       storer_result_dir, storer_username, storer_hostname, user = None):
     """Creates a configuration file describing the current submission:
@@ -80,35 +138,49 @@ def submission_config(vmcfg, account, assignment, course_id, upload_time,
        - the remainder of the assignment configuration
        - the VM configuration
        The tester ID and tester configuration are added at the time of submission.
+
+       Returns a dict mapping each section name to a dict of options.
+       Use write_ini() to store it.
     """
-    machine_id = vmcfg.assignments().get_machine_id(assignment)
+    machine_id = vmcfg.assignments().settings(assignment)['machine']
 
-    sbcfg = ConfigParser.RawConfigParser()
-    sbcfg.add_section('Assignment')
-    sbcfg.set('Assignment', 'Account', account)
+    # Option names are lowercased, just like RawConfigParser would
+    # store them, so readers of submission-config see the same keys.
+    asscfg = {}
+    asscfg['account'] = account
     if user != None:
-        sbcfg.set('Assignment', 'SubmittingUser', user)
-    sbcfg.set('Assignment', 'Assignment', assignment)
-    sbcfg.set('Assignment', 'UploadTime', upload_time)
-    sbcfg.set('Assignment', 'CourseID', course_id)
+        asscfg['submittinguser'] = user
+    asscfg['assignment'] = assignment
+    asscfg['uploadtime'] = upload_time
+    asscfg['courseid'] = course_id
 
     # Add the remainder of the Assignment config
-    assignment_section = vmcfg.assignments().items(assignment)
-    for options in assignment_section:
-        sbcfg.set('Assignment', options[0], options[1])
+    asscfg.update(vmcfg.assignments().items(assignment))
 
-    sbcfg.add_section('Storer')
-    sbcfg.set('Storer', 'ResultsDest', storer_result_dir)
-    sbcfg.set('Storer', 'RemoteUsername', storer_username)
-    sbcfg.set('Storer', 'RemoteHostname', storer_hostname)
+    storercfg = {'resultsdest'    : storer_result_dir,
+                 'remoteusername' : storer_username,
+                 'remotehostname' : storer_hostname}
 
     # Add the VM config
-    sbcfg.add_section('Machine')
-    machine_section = vmcfg.config.items(machine_id)
-    for options in machine_section:
-        sbcfg.set('Machine', options[0], options[1])
+    machinecfg = dict(vmcfg.config.items(machine_id))
 
-    return sbcfg
+    return {'Assignment' : asscfg,
+            'Storer'     : storercfg,
+            'Machine'    : machinecfg}
+
+
+def write_ini(handle, section, options):
+    """Write the `options' dict as the INI section `section' to the
+    opened file handle.
+
+    The output can be read back by RawConfigParser. There is no need
+    to go through RawConfigParser to build it: a submission config is
+    just a few key/value pairs without any interpolation.
+    """
+    handle.write('[%s]\n' % section)
+    for key, value in sorted(options.iteritems()):
+        handle.write('%s = %s\n' % (key, str(value).replace('\n', '\n\t')))
+    handle.write('\n')
 
 
 
@@ -122,19 +194,27 @@ def submission_backup_prefix(course_id, assignment, user, upload_time):
     return '%s_%s_%s_%s_' % (course_id, assignment, user, upload_time)
 
 
+def _fast_copy(src, dst):
+    """Copies the contents of src to dst through a buffer much larger
+    than the one shutil.copyfile() uses."""
+    with open(src, 'rb') as in_file:
+        with open(dst, 'wb') as out_file:
+            shutil.copyfileobj(in_file, out_file, _COPY_BUF_SIZE)
+
+
 def submission_backup(back_dir, submission_filename, sbcfg):
     """Make a backup for this submission.
 
     Each normal submission entry is of the following structure:
     +--$back_dir/
     |  +--git/
-    |  |  +--archive/
-    |  |  |  +-- X              (all the files from the archive)
-    |  |  |  +-- Y              (all the files from the archive)
     |  |  +--submission-config  config describing the submission
     |  |                        (user, uploadtime, assignment)
     |  +--archive.zip           the original (unmodified) archive
 
+    The archive is not expanded: only archive.zip is ever sent to the
+    testers. It is still checked to be safe to unzip.
+
 
     Each large submission entry is of the following structure:
     +--$back_dir/
@@ -145,29 +225,28 @@ def submission_backup(back_dir, submission_filename, sbcfg):
 
     """
     back_git = paths.dir_submission_git(back_dir)
-    back_arc = paths.dir_submission_expanded_archive(back_dir)
     back_cfg = paths.submission_config_file(back_dir)
     back_zip = paths.submission_archive_file(back_dir)
     back_md5 = paths.submission_md5_file(back_dir)
 
-    # make sure the directory path exists
-    if not os.path.exists(back_git):
-        os.makedirs(back_git)
+    # back_dir is always a new, empty, directory
+    os.mkdir(back_git)
 
-    # write the config. Do this before unzipping (which might fail)
-    # to make sure we have the dates correctly stored.
+    # write the config. Do this before checking the archive (which
+    # might fail) to make sure we have the dates correctly stored.
     with open(back_cfg, 'w') as handle:
-        sbcfg.write(handle)
+        for section in sorted(sbcfg):
+            write_ini(handle, section, sbcfg[section])
 
-    if sbcfg.get('Assignment', 'AssignmentStorage').lower() == "large":
-        shutil.copyfile(submission_filename, back_md5)
+    if sbcfg['Assignment'].get('assignmentstorage', '').lower() == "large":
+        _fast_copy(submission_filename, back_md5)
     else:
         # copy the (unmodified) archive. This should be the first thing we
         # do, to make sure the uploaded submission is on the server no
         # matter what happens next
-        shutil.copyfile(submission_filename, back_zip)
-        # unzip the archive, but check if it has absolute paths or '..'
-        ziputil.unzip_safely(submission_filename, back_arc)
+        _fast_copy(submission_filename, back_zip)
+        # check the archive's paths and contents
+        ziputil.check_archive_paths(submission_filename)
 
     logger.info('Stored submission in temporary directory %s', back_dir)
 
@@ -177,10 +256,10 @@ def submission_git_commit(dest, user, assignment):
     """Submit in git the data from the dest subdirectory of the
     repository.
     """
-    subprocess.Popen(['git', 'add', '--force', '.'], cwd=dest).wait()
-    subprocess.Popen(['git', 'commit', '--allow-empty', '.',
-                      '-m "Updated ' + user + '\' submission for ' +
-                      assignment + '"'], cwd=dest).wait()
+    msg = "Updated %s's submission for %s" % (user, assignment)
+    subprocess.check_call(['git', 'add', '--force', '.'], cwd=dest)
+    subprocess.check_call(['git', 'commit', '--allow-empty', '-m', msg, '.'],
+                          cwd=dest)
 
 
 
@@ -198,12 +277,23 @@ def save_submission_in_storer(vmcfg, submission_filename, account, assignment,
     """
     vmpaths = paths.VmcheckerPaths(vmcfg.root_path())
 
-    dir_name = 'sb_' + str(upload_time) + '_rnd' + str(random.randint(0, 1000))
-    # make name more pleasant to use for commandline
-    dir_name = dir_name.replace(' ', '__').replace(':', '.')
+    sbroot = vmpaths.dir_submission_root(assignment, account)
+    try:
+        os.makedirs(sbroot)
+    except OSError:
+        if not os.path.isdir(sbroot):
+            raise
 
+    # make name more pleasant to use for commandline
+    prefix = 'sb_%s_' % str(upload_time).replace(' ', '__').replace(':', '.')
     cur_sb = vmpaths.dir_cur_submission_root(assignment, account)
-    new_sb = vmpaths.dir_new_submission_root(assignment, account, dir_name)
+    new_sb = tempfile.mkdtemp(prefix=prefix, dir=sbroot)
+    # mkdtemp() creates the directory as 0700. With POSIX ACLs the
+    # group bits are the ACL mask, so that would lock the other
+    # vmchecker users out of it. Copy the mode bits of the parent
+    # directory instead, and with them its ACL mask. Any setgid or
+    # sticky bit of the parent is copied along.
+    os.chmod(new_sb, stat.S_IMODE(os.stat(sbroot).st_mode))
 
     sbcfg = submission_config(vmcfg, account, assignment, course_id, upload_time,
                               paths.dir_submission_results(new_sb),
@@ -211,19 +301,84 @@ def save_submission_in_storer(vmcfg, submission_filename, account, assignment,
                               vmcfg.storer_hostname(),
                               user = user)
 
-    with vmcfg.assignments().lock(vmpaths, assignment):
-        # write data to the backup
-        submission_backup(new_sb, submission_filename, sbcfg)
+    # write data to the backup. new_sb is private to this submission,
+    # so the copying and checking is done without holding the lock.
+    submission_backup(new_sb, submission_filename, sbcfg)
 
-        # commit in git only part of the files (not the 'archive.zip')
+    # the lock only serializes the git commit and the symlink swap
+    with vmcfg.assignments().lock(vmpaths, assignment):
+        # commit in git only part of the files (not the 'archive.zip').
+        # NOTE: the archive would first need to be expanded with
+        # ziputil.unzip_safely() into paths.dir_submission_expanded_archive()
         #git_dest = paths.dir_submission_git(new_sb)
         #submission_git_commit(git_dest, user, assignment)
 
         # create a new symlink, or make the old one point to the
         # current new submission. The symlink is not stored in git.
-        if os.path.exists(cur_sb):
-            os.unlink(cur_sb)
-        os.symlink(new_sb, cur_sb)
+        # The link is created under a temporary name and renamed over
+        # the old one, so readers never find it missing.
+        tmp_sb = cur_sb + '.new'
+        try:
+            os.symlink(new_sb, tmp_sb)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            # left behind by an interrupted submission
+            os.unlink(tmp_sb)
+            os.symlink(new_sb, tmp_sb)
+        os.rename(tmp_sb, cur_sb)
+
+def _static_bundle_part(dest, src):
+    """Returns a (zinfo, data) entry for ziputil.create_zip() storing
+    the file src as dest. The contents of src are read from disk only
+    the first time and after src is modified.
+
+    Returns None if src is too large to be kept in memory."""
+    st = os.stat(src)
+    if st.st_size > _STATIC_BUNDLE_PART_MAX_BYTES:
+        _STATIC_BUNDLE_PARTS.pop(src, None)
+        return None
+    cached = _STATIC_BUNDLE_PARTS.get(src)
+    # ctime also catches chmod, which changes the stored permissions
+    version = (st.st_mtime, st.st_ctime, st.st_size)
+    if cached is None or cached[0] != version:
+        with open(src, 'rb') as handle:
+            data = handle.read()
+        in_cache = sum(len(entry[2]) for entry in _STATIC_BUNDLE_PARTS.values())
+        if in_cache + len(data) > _STATIC_BUNDLE_PARTS_MAX_BYTES:
+            _STATIC_BUNDLE_PARTS.clear()
+        cached = (version, st, data)
+        _STATIC_BUNDLE_PARTS[src] = cached
+    return (ziputil.file_zipinfo(dest, cached[1]), cached[2])
+
+
+def _check_archive_once(sbroot, arch_path, should_not_contain):
+    """Runs check_archive_for_file_override() on the submission
+    archive, unless a previous run already accepted the very same
+    archive for the same should_not_contain names.
+
+    Successful checks are recorded next to the archive, so
+    reevaluating a stored submission does not rescan it."""
+    stamp_file = paths.submission_archive_validated_file(sbroot)
+    st = os.stat(arch_path)
+    stamp = '%r %d\n%s\n' % (st.st_mtime, st.st_size,
+                              '\n'.join(sorted(should_not_contain)))
+    try:
+        with open(stamp_file) as handle:
+            if handle.read() == stamp:
+                return
+    except IOError:
+        pass
+
+    check_archive_for_file_override(arch_path, should_not_contain)
+
+    try:
+        with open(stamp_file, 'w') as handle:
+            handle.write(stamp)
+    except IOError as e:
+        # not fatal: the archive will just be checked again next time
+        logger.warn('Could not write %s: %s', stamp_file, e)
+
 
 def create_testing_bundle(vmcfg, account, assignment, course_id):
     """Creates a testing bundle.
@@ -242,36 +397,48 @@ def create_testing_bundle(vmcfg, account, assignment, course_id):
     sbroot = vmpaths.dir_cur_submission_root(assignment, account)
 
     asscfg  = vmcfg.assignments()
-    machine = asscfg.get(assignment, 'Machine')
+    machine = asscfg.settings(assignment)['machine']
     machinecfg = config.VirtualMachineConfig(vmcfg, machine)
 
     rel_file_list = [ ('run.sh',   machinecfg.guest_run_script()),
                       ('build.sh', machinecfg.guest_build_script()),
-                      ('tests.zip', vmcfg.assignments().tests_path(vmpaths, assignment)),
+                      ('tests.zip', asscfg.tests_path(vmpaths, assignment)),
                       ('submission-config', paths.submission_config_file(sbroot)) ]
 
     # Get the assignment submission type (zip archive vs. MD5 Sum).
     # Large assignments do not have any archive.zip configured.
-    if asscfg.getd(assignment, "AssignmentStorage", "").lower() != "large":
+    if asscfg.settings(assignment)['storage'] != "large":
         rel_file_list += [ ('archive.zip', \
                 paths.submission_archive_file(sbroot)) ]
 
         # check if the archive does not contain some weird paths that might
         # lead to file override
-        # at this point, we already override tests.zip, because we are
-        # doing safely_unzip when storing the backup
         arch_path = paths.submission_archive_file(sbroot)
         arch_path = vmpaths.abspath(arch_path)
-        should_not_contain = map(lambda f: f[0], rel_file_list)
-        check_archive_for_file_override(arch_path, should_not_contain)
+        should_not_contain = frozenset(dst for (dst, _) in rel_file_list)
+        _check_archive_once(sbroot, arch_path, should_not_contain)
 
     if machinecfg.custom_runner() != '':
         rel_file_list += [ ( machinecfg.custom_runner(), machinecfg.custom_runner() ) ]
 
     file_list = [ (dst, vmpaths.abspath(src)) for (dst, src) in rel_file_list if src != '' ]
-
-    # builds archive with configuration
+    # the static parts come from memory, unless they are too large
+    data_list = []
+    disk_list = []
+    for (dst, src) in file_list:
+        part = None
+        if dst not in _LIVE_BUNDLE_FILES:
+            part = _static_bundle_part(dst, src)
+        if part is None:
+            disk_list.append((dst, src))
+        else:
+            data_list.append(part)
+
+    # builds archive with configuration. The assignment lock only
+    # covers reading the submission's files: it is released before
+    # the bundle is sent to a tester.
     with vmcfg.assignments().lock(vmpaths, assignment):
+        bundle_path = None
         try:
             # creates the zip archive with an unique name
             with tempfile.NamedTemporaryFile(
@@ -279,10 +446,11 @@ def create_testing_bundle(vmcfg, account, assignment, course_id):
                     prefix='%s_%s_%s_' % (course_id, assignment, account),
                     dir=vmpaths.dir_storer_tmp(),
                     delete=False) as handle:
-                logger.info('Creating bundle package %s', handle.name)
-                ziputil.create_zip(handle, file_list)
+                bundle_path = handle.name
+                logger.info('Creating bundle package %s', bundle_path)
+                ziputil.create_zip(handle, disk_list, data_list)
 
-                return handle.name
+                return bundle_path
 
         except:
             logger.error('Failed to create zip archive %s', bundle_path)
@@ -290,34 +458,27 @@ def create_testing_bundle(vmcfg, account, assignment, course_id):
                   # to be reported.
 
 def get_tester_queue_contents(vmcfg, tester_id):
-    # connect to the tester
     tstcfg = vmcfg.testers()
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    # run 'ls' in the queue_path and get it's output.
+    cmd = 'ls -ctgG ' + tstcfg.queue_path(tester_id)
+    chan = _start_on_tester(vmcfg, tester_id, cmd)
     try:
-        client.load_system_host_keys(vmcfg.known_hosts_file())
-        client.connect(tstcfg.hostname(tester_id),
-                       username=tstcfg.login_username(tester_id),
-                       key_filename=vmcfg.storer_sshid(),
-                       look_for_keys=False)
-
-        # run 'ls' in the queue_path and get it's output.
-        cmd = 'ls -ctgG ' + tstcfg.queue_path(tester_id)
-        stdin, stdout, stderr = client.exec_command(cmd)
-        data = stdout.readlines()
-        for f in [stdin, stdout, stderr]: f.close()
-        if len(data) > 0:
-            data = data[1:]
-            return data
-
+        data = chan.makefile('rb').readlines()
     finally:
-        client.close()
+        chan.close()
+    if len(data) > 0:
+        data = data[1:]
+        return data
 
 def get_least_busy_tester(vmcfg, testers):
     min_num_jobs = None
     least_busy_tester = None
+    with _PENDING_LOCK:
+        pending = [entry[2] for entry in _pending_bundles]
     for tester in testers:
         num_jobs = len(get_tester_queue_contents(vmcfg, tester))
+        # deferred bundles are not in the tester's queue yet
+        num_jobs += pending.count(tester)
         if min_num_jobs is None or num_jobs < min_num_jobs:
             min_num_jobs = num_jobs
             least_busy_tester = tester
@@ -325,31 +486,194 @@ def get_least_busy_tester(vmcfg, testers):
     return least_busy_tester
 
 
-def ssh_bundle(vmcfg, bundle_path, tester):
-    """Sends a bundle over ssh to the tester machine"""
+def _connect_tester(vmcfg, tester_hostname, tester_username):
+    """Opens an authenticated ssh connection to a tester machine."""
+    client = paramiko.SSHClient()
+    # XXX cannot validate remote key, because www-data does not
+    # have $home/.ssh/known_hosts where to store such info. For
+    # now, we'll assume the remote host is the desired one.
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        client.load_system_host_keys(vmcfg.known_hosts_file())
+        client.connect(tester_hostname, port=_DEFAULT_SSH_PORT,
+                       username=tester_username,
+                       key_filename=vmcfg.storer_sshid(),
+                       look_for_keys=False,
+                       timeout=_SSH_CONNECT_TIMEOUT)
+        client.get_transport().set_keepalive(_SSH_KEEPALIVE_INTERVAL)
+    except:
+        client.close()
+        raise
+    return client
+
+
+def _is_connected(client):
+    """Returns True if the ssh connection of client is still up."""
+    t = client.get_transport()
+    return t is not None and t.is_active()
+
+
+def _get_ssh_client(vmcfg, tester_hostname, tester_username, stale=None):
+    """Returns a SSHClient connected to the tester machine.
+
+    The connection is kept open and reused by later calls, so a burst
+    of submissions pays for a single ssh handshake. stale is a client
+    the caller found to be broken: if it is still in the pool, it is
+    replaced by a new connection.
+
+    The pool is not locked while connecting, so a tester that does
+    not answer does not hold up the threads talking to other testers."""
+    key = (tester_hostname, tester_username)
+    with _SSH_POOL_LOCK:
+        client = _SSH_POOL.get(key)
+        if client is not None and (client is stale or not _is_connected(client)):
+            del _SSH_POOL[key]
+            client.close()
+            client = None
+        if client is not None:
+            return client
+
+    client = _connect_tester(vmcfg, tester_hostname, tester_username)
+    with _SSH_POOL_LOCK:
+        other = _SSH_POOL.get(key)
+        if other is not None and _is_connected(other):
+            # another thread connected in the meantime
+            client.close()
+            return other
+        _SSH_POOL[key] = client
+        return client
+
+
+def _close_ssh_pool():
+    """Closes all the connections opened by _get_ssh_client()"""
+    with _SSH_POOL_LOCK:
+        for client in _SSH_POOL.values():
+            client.close()
+        _SSH_POOL.clear()
+
+atexit.register(_close_ssh_pool)
+
+
+def _start_command(client, command):
+    """Runs command on the other end of client's connection and
+    returns the channel connected to its stdin and stdout."""
+    # a connection that was dropped without us noticing must not
+    # hang the submission for paramiko's default of one hour
+    chan = client.get_transport().open_session(timeout=_SSH_CONNECT_TIMEOUT)
+    try:
+        chan.exec_command(command)
+    except:
+        chan.close()
+        raise
+    return chan
+
+
+def _start_on_tester(vmcfg, tester, command):
+    """Runs command on the tester, over a pooled ssh connection, and
+    returns the channel connected to its stdin and stdout.
+
+    The tester may have dropped an idle pooled connection, so if the
+    command cannot be started it is tried once more on a fresh one.
+    Nothing was sent to the command at that point, so this is always
+    safe. Failures after the command started are not retried."""
     tstcfg = vmcfg.testers()
     tester_username  = tstcfg.login_username(tester)
     tester_hostname  = tstcfg.hostname(tester)
-    tester_queuepath = tstcfg.queue_path(tester)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((tester_hostname, _DEFAULT_SSH_PORT))
-    t = paramiko.Transport(sock)
+    client = _get_ssh_client(vmcfg, tester_hostname, tester_username)
+    try:
+        return _start_command(client, command)
+    except paramiko.ChannelException:
+        if _is_connected(client):
+            # The connection works, but the tester refused a new
+            # session (e.g. sshd's MaxSessions was reached). Other
+            # threads may be streaming on it, so it is not replaced.
+            raise
+        client = _get_ssh_client(vmcfg, tester_hostname, tester_username,
+                                 stale=client)
+        return _start_command(client, command)
+    except (socket.error, EOFError, paramiko.SSHException):
+        client = _get_ssh_client(vmcfg, tester_hostname, tester_username,
+                                 stale=client)
+        return _start_command(client, command)
+
+
+class _ChannelWriter(object):
+    """File object writing into the stdin of a remote command.
+
+    If the command exits without reading all its input (e.g. because
+    the destination is missing) the rest of the data is dropped: the
+    exit status of the command tells what went wrong, while sendall()
+    would only fail with "Socket is closed"."""
+    def __init__(self, chan):
+        self.chan = chan
+
+    def write(self, data):
+        if self.chan.exit_status_ready():
+            return
+        try:
+            self.chan.sendall(data)
+        except socket.error:
+            if not self.chan.exit_status_ready():
+                raise
+
+    def close(self):
+        """Signals the end of the input to the remote command."""
+        if not self.chan.exit_status_ready():
+            self.chan.shutdown_write()
+
+
+def _stream_file(vmcfg, tester, local_path, remote_path):
+    """Copies local_path to remote_path on the tester.
+
+    The file is pushed as a single stream into a remote 'cat', instead
+    of going through SFTP's request/acknowledge protocol."""
+    chan = _start_on_tester(vmcfg, tester, 'cat > ' + pipes.quote(remote_path))
+    try:
+        writer = _ChannelWriter(chan)
+        with open(local_path, 'rb') as handle:
+            shutil.copyfileobj(handle, writer, _STREAM_BUF_SIZE)
+        writer.close()
+        status = chan.recv_exit_status()
+    finally:
+        chan.close()
+    if status != 0:
+        raise IOError('Copying %s to %s failed with exit status %d' %
+                      (local_path, remote_path, status))
+
+
+def _stream_files_as_tar(vmcfg, tester, local_paths, remote_dir):
+    """Copies all local_paths into remote_dir on the tester, as a
+    single tar stream."""
+    chan = _start_on_tester(vmcfg, tester, 'tar xf - -C ' + pipes.quote(remote_dir))
     try:
-        t.start_client()
-        # XXX cannot validate remote key, because www-data does not
-        # have $home/.ssh/known_hosts where to store such info. For
-        # now, we'll assume the remote host is the desired one.
-        #remotekey = t.get_remote_server_key()
-        key = paramiko.RSAKey.from_private_key_file(vmcfg.storer_sshid())
-        # todo check DSA keys too
-        # key = paramiko.DSAKey.from_private_key_file(vmcfg.storer_sshid())
-        t.auth_publickey(tester_username, key)
-        sftp = paramiko.SFTPClient.from_transport(t)
-        # XXX os.path.join is not correct here as these are paths on the
-        # remote machine.
-        sftp.put(bundle_path, os.path.join(tester_queuepath, os.path.basename(bundle_path)))
+        writer = _ChannelWriter(chan)
+        tar = tarfile.open(mode='w|', fileobj=writer, bufsize=_STREAM_BUF_SIZE)
+        for local_path in local_paths:
+            tar.add(local_path, arcname=os.path.basename(local_path))
+        tar.close()
+        writer.close()
+        status = chan.recv_exit_status()
     finally:
-        t.close()
+        chan.close()
+    if status != 0:
+        raise IOError('Copying %d bundles to %s failed with exit status %d' %
+                      (len(local_paths), remote_dir, status))
+
+
+def ssh_bundles(vmcfg, bundle_paths, tester):
+    """Sends several bundles over ssh to the tester machine, using a
+    single stream for all of them"""
+    tester_queuepath = vmcfg.testers().queue_path(tester)
+    _stream_files_as_tar(vmcfg, tester, bundle_paths, tester_queuepath)
+
+
+def ssh_bundle(vmcfg, bundle_path, tester):
+    """Sends a bundle over ssh to the tester machine"""
+    tester_queuepath = vmcfg.testers().queue_path(tester)
+    # XXX os.path.join is not correct here as these are paths on the
+    # remote machine.
+    remote_path = os.path.join(tester_queuepath, os.path.basename(bundle_path))
+    _stream_file(vmcfg, tester, bundle_path, remote_path)
 
 
 
@@ -361,51 +685,145 @@ def submitted_too_soon(vmcfg, assignment, account, check_eval_queueing_time):
     without waiting the amount of time specified in the config file.
     """
     vmpaths = paths.VmcheckerPaths(vmcfg.root_path())
-    subm = submissions.Submissions(vmpaths)
-    if not subm.submission_exists(assignment, account):
+    # the common case for a first submission: nothing to look at
+    if not os.path.isdir(vmpaths.dir_cur_submission_root(assignment, account)):
         return False
 
+    # The *_str getters return None if there is no submission, so
+    # the submission config is only parsed once.
+    subm = submissions.Submissions(vmpaths)
     if check_eval_queueing_time:
-        check_time = subm.get_eval_queueing_time(assignment, account)
+        check_time_str = subm.get_eval_queueing_time_str(assignment, account)
     else:
-        check_time = subm.get_upload_time(assignment, account)
+        check_time_str = subm.get_upload_time_str(assignment, account)
 
-    if check_time is None:
+    if check_time_str is None:
         return False
 
+    check_time = submissions.get_datetime_from_time_struct(
+        submissions.get_time_struct_from_str(check_time_str))
+
     remaining = check_time
-    remaining += vmcfg.assignments().timedelta(assignment)
+    remaining += vmcfg.assignments().settings(assignment)['timedelta']
     remaining -= datetime.datetime.now()
 
     return remaining > datetime.timedelta()
 
 
 
-def queue_for_testing(vmcfg, assignment, account, course_id):
+def _set_status(vmcfg, assignment, account, course_id, results_dest, status):
+    """Records the status of a submission whose results are stored
+    in results_dest."""
+    try:
+        submissions.write_grade_to(results_dest, status + "\n")
+    except Exception as e:
+        logger.error("Failed to write submission status: %s", e)
+        raise
+
+    update_db.update_grades(course_id, account, assignment)
+
+
+def queue_for_testing(vmcfg, assignment, account, course_id, defer=False):
     """Queue for testing the last submittion for the given assignment,
-    course and account on the least busy tester machine."""
+    course and account on the least busy tester machine.
+
+    If defer is True, the bundle is only built. It is sent later,
+    together with the other deferred bundles, by flush_pending().
+    This is useful when queueing many submissions at once. The
+    deferred bundles are flushed by this function too, once there
+    are enough of them or the oldest one waited long enough."""
     # Find the least busy tester, write this to the submission-config, and submit
-    machine = config.VirtualMachineConfig(vmcfg, vmcfg.assignments().get_machine_id(assignment))
+    machine = config.VirtualMachineConfig(vmcfg, vmcfg.assignments().settings(assignment)['machine'])
     testers = machine.get_tester_ids()
     tester = get_least_busy_tester(vmcfg, testers)
     vmpaths = paths.VmcheckerPaths(vmcfg.root_path())
     # Add the Tester config
     subm = submissions.Submissions(vmpaths)
     subm.add_tester_config(assignment, account, tester, vmcfg.testers().items(tester))
+    # The status is written next to this very submission, even if the
+    # student submits again before the bundle is sent.
+    results_dest = subm.get_results_dest(assignment, account)
     # Create submission bundle
     bundle_path = create_testing_bundle(vmcfg, account, assignment, course_id)
+    if defer:
+        with _PENDING_LOCK:
+            _pending_bundles.append((vmcfg, bundle_path, tester,
+                                     assignment, account, course_id,
+                                     results_dest, time.time()))
+            flush = (len(_pending_bundles) >= _PENDING_MAX_BUNDLES or
+                     time.time() - _pending_bundles[0][7] >= _PENDING_MAX_AGE)
+        if flush:
+            flush_pending()
+        return
+
+    # The assignment lock is NOT held here (create_testing_bundle()
+    # released it), so uploads for the same assignment can overlap.
     try:
         ssh_bundle(vmcfg, bundle_path, tester)
     finally:
         os.remove(bundle_path)
 
+    _set_status(vmcfg, assignment, account, course_id, results_dest,
+                submissions.STATUS_QUEUED)
+
+
+def flush_pending():
+    """Sends the bundles deferred by queue_for_testing() to their
+    testers, one stream per tester, and marks their submissions as
+    queued.
+
+    A tester that cannot be reached does not keep the bundles of the
+    other testers from being sent; the submissions meant for it are
+    marked as failed. The first error is raised after all testers
+    were tried."""
+    with _PENDING_LOCK:
+        pending = _pending_bundles[:]
+        del _pending_bundles[:]
+
+    failures = []
     try:
-        subm.write_grade(assignment, account, submissions.STATUS_QUEUED + "\n")
-    except Exception as e:
-        logger.error("Failed to write submission status: %s" % (str(e)))
-        raise
+        per_tester = {}
+        for entry in pending:
+            (vmcfg, _, tester) = entry[:3]
+            tstcfg = vmcfg.testers()
+            key = (tstcfg.hostname(tester), tstcfg.login_username(tester),
+                   tstcfg.queue_path(tester))
+            per_tester.setdefault(key, []).append(entry)
+
+        for entries in per_tester.values():
+            (vmcfg, _, tester) = entries[0][:3]
+            # The tester starts evaluating each bundle as soon as it
+            # is extracted from the stream, and from then on writes
+            # the status itself. Mark the submissions as queued before
+            # sending them, so their results are never overwritten.
+            for entry in entries:
+                try:
+                    _set_status(entry[0], entry[3], entry[4], entry[5],
+                                entry[6], submissions.STATUS_QUEUED)
+                except Exception:
+                    logger.exception('Could not mark %s/%s as queued',
+                                     entry[3], entry[4])
+                    failures.append(sys.exc_info())
+            try:
+                ssh_bundles(vmcfg, [entry[1] for entry in entries], tester)
+            except Exception:
+                logger.exception('Could not send %d bundles to tester %s',
+                                 len(entries), tester)
+                failures.append(sys.exc_info())
+                # don't leave them 'queued' forever
+                for entry in entries:
+                    try:
+                        _set_status(entry[0], entry[3], entry[4], entry[5],
+                                    entry[6], submissions.STATUS_ERROR)
+                    except Exception:
+                        logger.exception('Could not mark %s/%s as failed',
+                                         entry[3], entry[4])
+    finally:
+        for entry in pending:
+            os.remove(entry[1])
 
-    update_db.update_grades(course_id, account, assignment)
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
 
 
 
@@ -439,12 +857,15 @@ def check_submit_is_valid(vmcfg, course_id, assignment, account,
         msg += time.strftime(config.DATE_FORMAT, active_stop)  + '.'
         raise SubmittedTooSoonError(msg)
 
+    settings = vmcfg.assignments().settings(assignment)
+
     # chekf if the assignment is submited before the hard deadline
-    if vmcfg.assignments().is_deadline_hard(assignment):
-        deadline_str = vmcfg.assignments().get(assignment, 'Deadline')
+    if settings['hard_deadline']:
+        deadline_str = settings['deadline']
         assert(deadline_str)
-        deadline_ts = str_to_time(deadline_str)
-        upload_ts = str_to_time(upload_time_str)
+        deadline_ts = settings['deadline_ts']
+        # same as penalty.str_to_time(upload_time_str), without parsing again
+        upload_ts = time.mktime(upload_time)
         # extra minute grace time
         if upload_ts > DEADLINE_GRACE_TIME + deadline_ts:
             msg = 'You submited too late '
@@ -457,13 +878,13 @@ def check_submit_is_valid(vmcfg, course_id, assignment, account,
 
     # checks time difference between now and the last upload time
     if submitted_too_soon(vmcfg, assignment, account, check_eval_queueing_time):
-        min_time_between_subm = str(vmcfg.assignments().timedelta(assignment))
+        min_time_between_subm = str(settings['timedelta'])
         raise SubmittedTooSoonError(('You are submitting too fast.' +
                                     'Please allow %s between submissions') %
                                     min_time_between_subm)
 
     # check if the assignment is hidden and the user is an admin
-    if vmcfg.assignments().is_hidden(assignment) and \
+    if settings['hidden'] and \
             not account in vmcfg.admin_list() and \
             not skip_hidden_check:
         raise SubmittedHiddenAssignmentError('You are not allowed to submit ' +
@@ -484,8 +905,7 @@ def submit(submission_filename, assignment, account, course_id, user = None,
 
     Checks whether submissions are active for this course.
     """
-    vmcfg = config.StorerCourseConfig(CourseList().course_config(course_id))
-    vmpaths = paths.VmcheckerPaths(vmcfg.root_path())
+    vmcfg, vmpaths = _get_vmcfg(course_id)
 
     if forced_upload_time != None:
         skip_toosoon_check = True
@@ -495,10 +915,9 @@ def submit(submission_filename, assignment, account, course_id, user = None,
 
     check_submit_is_valid(vmcfg, course_id, assignment, account,
                      upload_time_str, skip_toosoon_check, skip_hidden_check, False)
-    storage_type = vmcfg.assignments().getd(assignment, "AssignmentStorage", "")
-    if storage_type.lower() != "large":
-        max_submission_size = vmcfg.assignments().max_submission_size(assignment)
-        check_archive_size(submission_filename, max_submission_size)
+    settings = vmcfg.assignments().settings(assignment)
+    if settings['storage'] != "large":
+        check_archive_size(submission_filename, settings['max_size'])
 
     save_submission_in_storer(vmcfg, submission_filename, account, assignment,
                               course_id, upload_time_str, user = user)
@@ -508,13 +927,12 @@ def submit(submission_filename, assignment, account, course_id, user = None,
         submissions.Submissions(vmpaths).write_grade(assignment, account,
                 submissions.STATUS_SAVED + "\n")
     except Exception as e:
-        logger.error("Failed to write submission status: %s" % (str(e)))
+        logger.error("Failed to write submission status: %s", e)
         raise
 
     update_db.update_grades(course_id, account, assignment)
 
-    if vmcfg.assignments().submit_only(assignment) or \
-            storage_type.lower() == "large":
+    if settings['submit_only'] or settings['storage'] == "large":
         return
 
     queue_for_testing(vmcfg, assignment, account, course_id)
@@ -523,13 +941,12 @@ def submit(submission_filename, assignment, account, course_id, user = None,
 def evaluate_large_submission(archive_fname, assignment, account, course_id):
     """Queue for testing a large submission"""
 
-    vmcfg = config.StorerCourseConfig(CourseList().course_config(course_id))
-    storage_type = vmcfg.assignments().getd(assignment, "AssignmentStorage", "")
-    if storage_type.lower() != "large":
+    vmcfg, vmpaths = _get_vmcfg(course_id)
+    storage_type = vmcfg.assignments().settings(assignment)['storage']
+    if storage_type != "large":
         raise Exception("Called evaluate_large_submission for a %s submission" %
                         storage_type)
 
-    vmpaths = paths.VmcheckerPaths(vmcfg.root_path())
     subm = submissions.Submissions(vmpaths)
     cur_sb_root = vmpaths.dir_cur_submission_root(assignment, account)
     results_dir = paths.dir_submission_results(cur_sb_root)
@@ -2,6 +2,8 @@
 
 
 import os
+import time
+import binascii
 
 
 
@@ -30,17 +32,56 @@ def unzip_safely(archive_filename, destination):
     """
     z = zipfile.ZipFile(archive_filename)
     try:
-        for name in z.namelist():
-            if os.path.isabs(name) or name.find('..') != -1:
-                raise zipfile.BadZipfile
+        _check_member_paths(z)
         z.extractall(destination)
     finally:
         z.close()
 
+def check_archive_paths(archive_filename):
+    """Runs the sanity checks of unzip_safely() without unzipping.
+
+    Raises zipfile.BadZipfile if the archive is not a valid zip, if
+    it stores absolute paths or paths using '..' or if any member
+    fails its CRC check (as it would when unzipped).
+    """
+    z = zipfile.ZipFile(archive_filename)
+    try:
+        _check_member_paths(z)
+        _check_member_contents(z)
+    finally:
+        z.close()
+
+def _check_member_paths(z):
+    """Raises zipfile.BadZipfile if any member of the opened ZipFile
+    z would be unzipped outside the destination directory."""
+    for name in z.namelist():
+        if os.path.isabs(name) or name.find('..') != -1:
+            raise zipfile.BadZipfile
+
+def _check_member_contents(z):
+    """Raises zipfile.BadZipfile if any member of the opened ZipFile
+    z cannot be read back or does not match its CRC.
+
+    This zipfile does not check the CRCs itself, so they are computed
+    here."""
+    for zinfo in z.infolist():
+        member = z.open(zinfo)
+        crc = 0
+        while True:
+            data = member.read(1 << 20)
+            if not data:
+                break
+            crc = binascii.crc32(data, crc)
+        if crc & 0xffffffff != zinfo.CRC:
+            raise zipfile.BadZipfile
+
 def check_archive_for_file_override(archive_filename, \
-        should_not_contain=['tests.zip', 'archive.zip', 'run.sh', 'build.sh', 'course-config', 'submission-config']):
+        should_not_contain=frozenset(['tests.zip', 'archive.zip', 'run.sh', 'build.sh', 'course-config', 'submission-config'])):
     """Sanyity check for archive contents file names.
     We do not want to override certain file names.
+
+    should_not_contain is tested once per archive member, so pass a
+    set when checking against many names.
     """
     z = zipfile.ZipFile(archive_filename)
     try:
@@ -68,14 +109,33 @@ def check_archive_size(archive_filename, max_file_size=10*1024*1024):
         z.close()
 
 
-def create_zip(file_handler, file_list):
+def file_zipinfo(dest, st):
+    """Build the ZipInfo that ZipFile.write() would use to store, as
+    dest, a file whose os.stat() result is st."""
+    # normalize the name the same way ZipFile.write() does
+    arcname = os.path.normpath(os.path.splitdrive(dest)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L  # Unix attributes
+    return zinfo
+
+
+def create_zip(file_handler, file_list, data_list=()):
     """Create a zip into the opened file_handler. The zip is comprised
-    of all files specified in file_list"""
+    of all files specified in file_list and of the in-memory entries
+    in data_list.
+
+    file_list holds (dest, src) pairs naming files on disk. data_list
+    holds (zinfo, data) pairs, where zinfo is the ZipInfo (see
+    file_zipinfo()) describing the entry and data is its contents.
+    """
     zip_ = zipfile.ZipFile(file_handler, 'w')
     try:
         for (dest, src) in file_list:
             assert os.path.isfile(src), 'File %s is missing' % src
             zip_.write(src, dest)
+        for (zinfo, data) in data_list:
+            zip_.writestr(zinfo, data)
     finally:
         zip_.close()
-